@@ -1,143 +1,437 @@
 # api/verify.py
 
-from http.server import BaseHTTPRequestHandler
+import asyncio
 import json
+import logging
 import hashlib
 import hmac
 import time
 import os
-from datetime import datetime
+import ssl
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import httpx
+from starlette.applications import Starlette
+from starlette.endpoints import HTTPEndpoint
+from starlette.responses import Response
+from starlette.routing import Route
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # 环境变量
 SECRET_KEY = os.getenv('SECRET_KEY', '').encode()
 SUPABASE_URL = os.getenv('SUPABASE_URL', '')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY', '')
-
-# 全局 Supabase 客户端
-_supabase_client = None
-
-
-def get_supabase():
-    """获取 Supabase 客户端"""
-    global _supabase_client
-
-    if _supabase_client is None:
-        # 检查环境变量
-        if not SUPABASE_URL or not SUPABASE_KEY:
-            print(f"[ERROR] 环境变量缺失:")
-            print(f"  SUPABASE_URL: {'✓' if SUPABASE_URL else '✗ 缺失'}")
-            print(f"  SUPABASE_KEY: {'✓' if SUPABASE_KEY else '✗ 缺失'}")
-            print(f"  SECRET_KEY: {'✓' if SECRET_KEY else '✗ 缺失'}")
-            return None
-
+SUPABASE_DB_URL = os.getenv('SUPABASE_DB_URL', '')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING').upper()
+
+# 日志：默认只输出 WARNING 及以上，设置 LOG_LEVEL=INFO 查看请求明细
+# 无法识别的级别名回退为 WARNING，避免导入时抛 ValueError
+log = logging.getLogger('verify')
+_level = getattr(logging, LOG_LEVEL, None)
+log.setLevel(_level if isinstance(_level, int) else logging.WARNING)
+if not log.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+    log.addHandler(_log_handler)
+    log.propagate = False
+
+
+def _json_bytes(data):
+    """序列化为 UTF-8 JSON 字节串"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+def _json_loads(body):
+    """解析请求体字节串"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+# 固定错误响应，导入时预先序列化: (状态码, 响应体)
+_ERR_MISSING_PARAMS = (400, _json_bytes({'valid': False, 'message': '参数不完整'}))
+_ERR_BAD_SIGNATURE = (403, _json_bytes({'valid': False, 'message': '签名验证失败'}))
+_ERR_BAD_TIMESTAMP = (400, _json_bytes({'valid': False, 'message': '请求时间无效'}))
+_ERR_RATE_LIMITED = (429, _json_bytes({'valid': False, 'message': '请求过于频繁，请稍后再试'}))
+_ERR_NOT_FOUND = (404, _json_bytes({'valid': False, 'message': '许可证不存在'}))
+_ERR_DISABLED = (403, _json_bytes({'valid': False, 'message': '许可证已被禁用'}))
+_ERR_BAD_JSON = (400, _json_bytes({'valid': False, 'message': 'JSON 格式错误'}))
+_ERR_SERVER = (500, _json_bytes({'valid': False, 'message': '服务器错误'}))
+
+# 预先完成密钥调度的 HMAC 原型，每次验签只需 copy()
+# digestmod 使用字符串形式，走 OpenSSL EVP 实现（可利用 SHA-NI 硬件加速）
+_HMAC_PROTO = hmac.new(SECRET_KEY, b'', 'sha256')
+
+# 冷启动时输出一次加密后端信息（LOG_LEVEL=INFO 可见）：OpenSSL 版本、
+# sha256 的实现模块（_hashlib 表示走 OpenSSL EVP，否则为 CPython 内置实现）及可用算法
+log.info("加密后端: %s, sha256 实现: %s, 可用算法: %s", ssl.OPENSSL_VERSION,
+         type(hashlib.new('sha256')).__module__, sorted(hashlib.algorithms_available))
+
+# 许可证行的进程内 LRU 缓存: {license_key: (license_info, 已绑定机器码集合, 过期时刻)}
+_LICENSE_CACHE = OrderedDict()
+_LICENSE_CACHE_MAX = 1024
+_LICENSE_CACHE_TTL = 30.0
+_license_cache_lock = threading.Lock()
+
+# 按 (IP, license_key) 的令牌桶限流，在验签和查库之前拒绝刷接口的请求
+# {(ip, license_key): (剩余令牌, 上次补充时刻)}
+_RATE_LIMIT_BUCKETS = OrderedDict()
+_RATE_LIMIT_MAX_KEYS = 10000
+_RATE_LIMIT_RATE = 5.0
+_RATE_LIMIT_BURST = 10.0
+_rate_limit_lock = threading.Lock()
+
+# PostgREST 连接：HTTP/2 + 长 keep-alive 连接池，热实例复用 TLS 连接
+_REST_HEADERS = {
+    'apikey': SUPABASE_KEY,
+    'Authorization': f'Bearer {SUPABASE_KEY}',
+    'Content-Type': 'application/json',
+}
+_POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60)
+
+# TLS 上下文在冷启动时创建，避免首个请求加载证书
+_SSL_CONTEXT = httpx.create_ssl_context()
+
+# 直连 Postgres 的 SQL（asyncpg 会缓存为服务端预编译语句）
+# 直连超时：主机不可达时尽快回退 PostgREST，而不是等 asyncpg 默认的 60 秒
+_PG_CONNECT_TIMEOUT = 5.0
+_PG_COMMAND_TIMEOUT = 10.0
+# 回退 PostgREST 后每隔多久在后台重试直连；切换后旧客户端延迟多久关闭
+_PG_RETRY_INTERVAL = 60.0
+_PG_FALLBACK_CLOSE_DELAY = 30.0
+_pg_retry_at = 0.0
+
+_SQL_VERIFY_AND_BIND = (
+    'SELECT status, expire_time, is_active, machine_id, max_devices '
+    'FROM verify_and_bind($1, $2, $3, $4)'
+)
+_SQL_INSERT_VERIFY_LOG = (
+    'INSERT INTO verify_logs (license_key, machine_id, verify_time, ip_address) '
+    'VALUES ($1, $2, $3, $4)'
+)
+
+
+def _check_postgrest_response(resp, action):
+    """PostgREST 返回错误时记录状态码和响应体（含错误详情）后抛出"""
+    if resp.is_error:
+        log.error("PostgREST %s 失败: HTTP %s %s", action, resp.status_code, resp.text)
+        resp.raise_for_status()
+
+
+class PostgrestDB:
+    """通过 PostgREST (HTTPS) 访问数据库"""
+
+    def __init__(self):
+        self.client = httpx.AsyncClient(
+            base_url=f'{SUPABASE_URL}/rest/v1',
+            headers=_REST_HEADERS,
+            verify=_SSL_CONTEXT,
+            http2=True,
+            limits=_POOL_LIMITS,
+        )
+
+    async def verify_and_bind(self, license_key, machine_id, now, ip_address):
+        """调用 verify_and_bind 存储过程，许可证不存在返回 None"""
+        resp = await self.client.post('/rpc/verify_and_bind', content=_json_bytes({
+            'p_license_key': license_key,
+            'p_machine_id': machine_id,
+            'p_now': now,
+            'p_ip_address': ip_address,
+        }))
+        _check_postgrest_response(resp, 'verify_and_bind')
+        rows = _json_loads(resp.content)
+        return rows[0] if rows else None
+
+    async def insert_verify_log(self, record):
+        """写入一条验证日志"""
+        resp = await self.client.post('/verify_logs', content=_json_bytes(record),
+                                      headers={'Prefer': 'return=minimal'})
+        _check_postgrest_response(resp, '写入 verify_logs')
+
+
+class AsyncpgDB:
+    """通过 asyncpg 直连 Postgres，省去 PostgREST 的 HTTPS 往返"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @classmethod
+    async def connect(cls):
+        """创建连接池"""
+        import asyncpg
+        pool = await asyncpg.create_pool(
+            dsn=SUPABASE_DB_URL, min_size=1, max_size=5, statement_cache_size=256,
+            timeout=_PG_CONNECT_TIMEOUT, command_timeout=_PG_COMMAND_TIMEOUT)
+        return cls(pool)
+
+    async def verify_and_bind(self, license_key, machine_id, now, ip_address):
+        """调用 verify_and_bind 存储过程，许可证不存在返回 None"""
+        row = await self.pool.fetchrow(
+            _SQL_VERIFY_AND_BIND, license_key, machine_id, now, ip_address)
+        return dict(row) if row is not None else None
+
+    async def insert_verify_log(self, record):
+        """写入一条验证日志"""
+        await self.pool.execute(
+            _SQL_INSERT_VERIFY_LOG, record['license_key'], record['machine_id'],
+            record['verify_time'], record['ip_address'])
+
+
+async def create_db():
+    """创建数据库访问对象：优先直连 Postgres，否则走 PostgREST；均不可用返回 None"""
+    global _pg_retry_at
+
+    if SUPABASE_DB_URL:
         try:
-            from supabase import create_client, Client
-            print(f"[INFO] 初始化 Supabase: {SUPABASE_URL[:30]}...")
-            _supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
-            print(f"[INFO] Supabase 客户端创建成功")
-            return _supabase_client
-        except ImportError as e:
-            print(f"[ERROR] Supabase 库导入失败: {e}")
-            return None
+            log.info("初始化 Postgres 连接池")
+            return await AsyncpgDB.connect()
         except Exception as e:
-            print(f"[ERROR] Supabase 初始化失败: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Postgres 连接失败，改用 PostgREST: %r", e)
+            _pg_retry_at = time.monotonic() + _PG_RETRY_INTERVAL
+
+    # 检查环境变量
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        log.error("环境变量缺失: SUPABASE_URL: %s, SUPABASE_KEY: %s, SECRET_KEY: %s",
+                  '✓' if SUPABASE_URL else '✗ 缺失',
+                  '✓' if SUPABASE_KEY else '✗ 缺失',
+                  '✓' if SECRET_KEY else '✗ 缺失')
+        return None
+
+    log.info("初始化 PostgREST 客户端: %s...", SUPABASE_URL[:30])
+    return PostgrestDB()
+
+
+# 数据库连接池归属守护线程中的常驻事件循环，跨调用复用。
+# 运行时可能为每次调用新建事件循环，连接池不能绑定在请求所在的循环上。
+_db_loop = asyncio.new_event_loop()
+threading.Thread(target=_db_loop.run_forever, name='verify-db', daemon=True).start()
+
+# 冷启动时即开始创建数据库访问对象，避免首个请求承担初始化开销
+_db_future = asyncio.run_coroutine_threadsafe(create_db(), _db_loop)
+_db_future_lock = threading.Lock()
+
+
+async def retry_asyncpg(fallback):
+    """回退到 PostgREST 后在后台重试直连，成功则替换数据库访问对象"""
+    global _db_future
+
+    try:
+        db = await AsyncpgDB.connect()
+    except Exception as e:
+        log.warning("Postgres 重连失败，继续使用 PostgREST: %r", e)
+        return
+
+    future = Future()
+    future.set_result(db)
+    with _db_future_lock:
+        _db_future = future
+    log.info("已恢复 Postgres 直连")
+
+    # 等仍在使用旧客户端的请求结束后再关闭
+    await asyncio.sleep(_PG_FALLBACK_CLOSE_DELAY)
+    await fallback.client.aclose()
+
+
+async def run_db(coro):
+    """在常驻事件循环上执行数据库协程并等待结果"""
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, _db_loop))
+
+
+async def get_db():
+    """获取数据库访问对象，不可用返回 None（下次调用重新创建）"""
+    global _db_future, _pg_retry_at
+
+    with _db_future_lock:
+        # 并发的首批请求共享同一个创建任务
+        if _db_future is None:
+            _db_future = asyncio.run_coroutine_threadsafe(create_db(), _db_loop)
+        future = _db_future
+    db = await asyncio.shield(asyncio.wrap_future(future))
+    if db is None:
+        with _db_future_lock:
+            if _db_future is future:
+                _db_future = None
+    elif SUPABASE_DB_URL and isinstance(db, PostgrestDB):
+        # 直连曾失败而回退到 PostgREST，到期后在后台重试，不阻塞当前请求
+        with _db_future_lock:
+            retry = time.monotonic() >= _pg_retry_at
+            if retry:
+                _pg_retry_at = time.monotonic() + _PG_RETRY_INTERVAL
+        if retry:
+            asyncio.run_coroutine_threadsafe(retry_asyncpg(db), _db_loop)
+    return db
+
+
+def parse_machine_ids(bound_machine):
+    """将逗号分隔的机器码字段解析为集合"""
+    return frozenset(m.strip() for m in bound_machine.split(',') if m.strip())
+
+
+def get_cached_license(license_key):
+    """读取未过期的缓存 (license_info, 机器码集合)，不存在或已过期返回 None"""
+    with _license_cache_lock:
+        entry = _LICENSE_CACHE.get(license_key)
+        if entry is None:
             return None
-
-    return _supabase_client
+        if entry[2] < time.monotonic():
+            del _LICENSE_CACHE[license_key]
+            return None
+        _LICENSE_CACHE.move_to_end(license_key)
+        return entry[0], entry[1]
+
+
+def cache_license(license_key, license_info, machine_set):
+    """缓存许可证行，超出容量时淘汰最久未使用的条目"""
+    with _license_cache_lock:
+        _LICENSE_CACHE[license_key] = (
+            license_info, machine_set, time.monotonic() + _LICENSE_CACHE_TTL)
+        _LICENSE_CACHE.move_to_end(license_key)
+        if len(_LICENSE_CACHE) > _LICENSE_CACHE_MAX:
+            _LICENSE_CACHE.popitem(last=False)
+
+
+def allow_request(ip_address, license_key):
+    """消耗一个令牌，令牌不足返回 False"""
+    key = (ip_address, license_key)
+    now = time.monotonic()
+    with _rate_limit_lock:
+        entry = _RATE_LIMIT_BUCKETS.get(key)
+        if entry is None:
+            tokens = _RATE_LIMIT_BURST
+        else:
+            tokens = min(_RATE_LIMIT_BURST, entry[0] + (now - entry[1]) * _RATE_LIMIT_RATE)
+            _RATE_LIMIT_BUCKETS.move_to_end(key)
+        if tokens < 1.0:
+            _RATE_LIMIT_BUCKETS[key] = (tokens, now)
+            return False
+        _RATE_LIMIT_BUCKETS[key] = (tokens - 1.0, now)
+        if len(_RATE_LIMIT_BUCKETS) > _RATE_LIMIT_MAX_KEYS:
+            _RATE_LIMIT_BUCKETS.popitem(last=False)
+        return True
+
+
+async def write_verify_log(db, record):
+    """写入验证日志（在常驻事件循环上执行，不阻塞响应）"""
+    try:
+        await db.insert_verify_log(record)
+    except Exception as log_error:
+        log.warning("日志记录失败: %s", log_error)
 
 
 def verify_signature(license_key, machine_id, timestamp, signature):
     """验证签名"""
-    msg = f"{license_key}{machine_id}{timestamp}"
-    expected = hmac.new(SECRET_KEY, msg.encode(), hashlib.sha256).hexdigest()
-    return hmac.compare_digest(expected, signature)
+    h = _HMAC_PROTO.copy()
+    h.update(license_key.encode())
+    h.update(machine_id.encode())
+    h.update(b'%d' % timestamp)
+    try:
+        sig_bytes = bytes.fromhex(signature)
+    except (TypeError, ValueError):
+        return False
+    return hmac.compare_digest(h.digest(), sig_bytes)
 
 
-def cors_headers():
-    """CORS 响应头"""
-    return {
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'POST, OPTIONS, GET',
-        'Access-Control-Allow-Headers': 'Content-Type',
-    }
+# CORS 响应头
+_CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS, GET',
+    'Access-Control-Allow-Headers': 'Content-Type',
+}
 
 
-class handler(BaseHTTPRequestHandler):
-    """Vercel Serverless 函数处理器"""
+def json_response(status_code, data):
+    """构造 JSON 响应"""
+    return raw_json_response(status_code, _json_bytes(data))
 
-    def do_OPTIONS(self):
+
+def raw_json_response(status_code, body):
+    """构造已序列化的 JSON 响应"""
+    return Response(body, status_code=status_code, headers=_CORS_HEADERS,
+                    media_type='application/json')
+
+
+class VerifyEndpoint(HTTPEndpoint):
+    """许可证验证端点"""
+
+    async def options(self, request):
         """处理 CORS 预检请求"""
-        self.send_response(200)
-        for key, value in cors_headers().items():
-            self.send_header(key, value)
-        self.end_headers()
+        return Response(status_code=200, headers=_CORS_HEADERS)
 
-    def do_GET(self):
+    async def get(self, request):
         """健康检查端点"""
-        supabase = get_supabase()
+        db = await get_db()
 
-        return self.send_json_response(200, {
+        return json_response(200, {
             'status': 'ok',
             'message': 'License verification API is running',
             'environment': {
                 'SECRET_KEY': '✓ 已设置' if SECRET_KEY else '✗ 未设置',
                 'SUPABASE_URL': '✓ 已设置' if SUPABASE_URL else '✗ 未设置',
                 'SUPABASE_KEY': '✓ 已设置' if SUPABASE_KEY else '✗ 未设置',
-                'SUPABASE_CLIENT': '✓ 连接成功' if supabase else '✗ 连接失败',
+                'SUPABASE_DB_URL': '✓ 已设置' if SUPABASE_DB_URL else '✗ 未设置',
+                'SUPABASE_CLIENT': '✓ 连接成功' if db else '✗ 连接失败',
             }
         })
 
-    def do_POST(self):
+    async def post(self, request):
         """处理 POST 请求"""
         try:
             # 1. 读取请求体
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length)
-            data = json.loads(body.decode('utf-8'))
+            body = await request.body()
+            data = _json_loads(body)
 
             # 2. 提取参数
             license_key = data.get('license_key', '').strip()
             machine_id = data.get('machine_id', '').strip()
-            timestamp = int(data.get('timestamp', 0))
+            try:
+                timestamp = int(data.get('timestamp', 0))
+            except (TypeError, ValueError):
+                return raw_json_response(*_ERR_BAD_TIMESTAMP)
             signature = data.get('signature', '')
 
-            print(f"[INFO] 收到验证请求: {license_key[:20]}..., {machine_id[:20]}...")
+            log.info("收到验证请求: %s..., %s...", license_key[:20], machine_id[:20])
 
             # 3. 基础验证
-            if not all([license_key, machine_id, signature]):
-                return self.send_json_response(400, {
-                    'valid': False,
-                    'message': '参数不完整'
-                })
-
-            # 4. 验证时间戳
-            current_time = int(time.time())
-            time_diff = abs(current_time - timestamp)
-            print(f"[INFO] 时间差: {time_diff}秒")
-
-            if time_diff > 300:
-                return self.send_json_response(400, {
+            if not license_key or not machine_id or not signature:
+                return raw_json_response(*_ERR_MISSING_PARAMS)
+
+            # 4. 限流（先于验签和查库）
+            ip_address = request.headers.get(
+                'X-Forwarded-For', request.client.host if request.client else '')
+            if not allow_request(ip_address, license_key):
+                log.info("请求过于频繁: %s, %s", ip_address, license_key)
+                return raw_json_response(*_ERR_RATE_LIMITED)
+
+            # 5. 验证时间戳
+            current_time = time.time_ns() // 1_000_000_000
+            if timestamp < current_time - 300 or timestamp > current_time + 300:
+                time_diff = abs(current_time - timestamp)
+                return json_response(400, {
                     'valid': False,
                     'message': f'请求时间无效（时间差{time_diff}秒）'
                 })
 
-            # 5. 验证签名
+            # 6. 验证签名
             if not verify_signature(license_key, machine_id, timestamp, signature):
-                print(f"[WARN] 签名验证失败")
-                return self.send_json_response(403, {
-                    'valid': False,
-                    'message': '签名验证失败'
-                })
+                log.warning("签名验证失败")
+                return raw_json_response(*_ERR_BAD_SIGNATURE)
 
-            print(f"[INFO] 签名验证通过")
+            log.info("签名验证通过")
 
-            # 6. 连接数据库
-            supabase = get_supabase()
-            if not supabase:
-                print(f"[ERROR] 无法连接数据库")
-                return self.send_json_response(500, {
+            # 7. 连接数据库
+            db = await get_db()
+            if not db:
+                log.error("无法连接数据库")
+                return json_response(500, {
                     'valid': False,
                     'message': '数据库连接失败，请检查环境变量',
                     'debug': {
@@ -146,78 +440,64 @@ class handler(BaseHTTPRequestHandler):
                     }
                 })
 
-            # 7. 查询许可证
-            print(f"[INFO] 查询许可证: {license_key}")
-            result = supabase.table('licenses').select('*').eq('license_key', license_key).execute()
+            # 8. 查询许可证：缓存命中且设备已绑定时无需访问数据库，
+            #    否则由 verify_and_bind 在一个事务内完成查询、绑定和日志记录
+            cached = get_cached_license(license_key)
+            if cached is not None and machine_id in cached[1]:
+                license_info, machine_set = cached
+                logged = False
+            else:
+                log.info("查询许可证: %s", license_key)
+                license_info = await run_db(db.verify_and_bind(
+                    license_key, machine_id, current_time, ip_address))
 
-            if not result.data:
-                print(f"[WARN] 许可证不存在: {license_key}")
-                return self.send_json_response(404, {
-                    'valid': False,
-                    'message': '许可证不存在'
-                })
+                if license_info is None:
+                    log.warning("许可证不存在: %s", license_key)
+                    return raw_json_response(*_ERR_NOT_FOUND)
+
+                logged = license_info.pop('status') == 'ok'
+                machine_set = parse_machine_ids(license_info.get('machine_id') or '')
+                cache_license(license_key, license_info, machine_set)
 
-            license_info = result.data[0]
-            print(f"[INFO] 找到许可证，过期时间: {license_info.get('expire_time')}")
+            log.info("找到许可证，过期时间: %s", license_info.get('expire_time'))
 
-            # 8. 验证状态
+            # 9. 验证状态
             if not license_info.get('is_active', False):
-                return self.send_json_response(403, {
-                    'valid': False,
-                    'message': '许可证已被禁用'
-                })
+                return raw_json_response(*_ERR_DISABLED)
 
-            # 9. 验证过期时间
-            expire_time = license_info['expire_time']
+            # 10. 验证过期时间
+            # expire_time 为空与 verify_and_bind 一致，视为已过期
+            expire_time = license_info.get('expire_time') or 0
             if current_time > expire_time:
-                expire_date = datetime.fromtimestamp(expire_time).strftime('%Y-%m-%d')
-                return self.send_json_response(403, {
+                t = time.gmtime(expire_time)
+                expire_date = f'{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}'
+                return json_response(403, {
                     'valid': False,
                     'message': f"许可证已于 {expire_date} 过期"
                 })
 
-            # 10. 机器码绑定
-            bound_machine = license_info.get('machine_id') or ''
-            max_devices = license_info.get('max_devices', 1)
-
-            if bound_machine:
-                machines = [m.strip() for m in bound_machine.split(',') if m.strip()]
-                if machine_id not in machines:
-                    if len(machines) >= max_devices:
-                        return self.send_json_response(403, {
-                            'valid': False,
-                            'message': f'许可证已绑定 {len(machines)} 台设备（上限 {max_devices}）'
-                        })
-                    # 绑定新设备
-                    machines.append(machine_id)
-                    print(f"[INFO] 绑定新设备: {machine_id}")
-                    supabase.table('licenses').update({
-                        'machine_id': ','.join(machines)
-                    }).eq('license_key', license_key).execute()
-            else:
-                # 首次激活
-                print(f"[INFO] 首次激活，绑定设备: {machine_id}")
-                supabase.table('licenses').update({
-                    'machine_id': machine_id,
-                    'activated_at': current_time
-                }).eq('license_key', license_key).execute()
+            # 11. 机器码绑定（新设备已由 verify_and_bind 绑定，未绑定说明已达上限）
+            if machine_id not in machine_set:
+                max_devices = license_info.get('max_devices', 1)
+                return json_response(403, {
+                    'valid': False,
+                    'message': f'许可证已绑定 {len(machine_set)} 台设备（上限 {max_devices}）'
+                })
 
-            # 11. 记录日志
-            try:
-                supabase.table('verify_logs').insert({
+            # 12. 记录日志（缓存命中路径提交到常驻事件循环，不等待写入完成）
+            if not logged:
+                asyncio.run_coroutine_threadsafe(write_verify_log(db, {
                     'license_key': license_key,
                     'machine_id': machine_id,
                     'verify_time': current_time,
-                    'ip_address': self.headers.get('X-Forwarded-For', self.client_address[0])
-                }).execute()
-            except Exception as log_error:
-                print(f"[WARN] 日志记录失败: {log_error}")
+                    'ip_address': ip_address
+                }), _db_loop)
 
-            # 12. 返回成功
+            # 13. 返回成功
             days_left = max(0, (expire_time - current_time) // 86400)
-            print(f"[INFO] 验证成功，剩余 {days_left} 天")
+            log.info("验证成功，剩余 %s 天", days_left)
 
-            return self.send_json_response(200, {
+            return json_response(200, {
                 'valid': True,
                 'expire_time': expire_time,
                 'days_remaining': days_left,
@@ -225,25 +505,13 @@ class handler(BaseHTTPRequestHandler):
             })
 
         except json.JSONDecodeError:
-            print(f"[ERROR] JSON 解析失败")
-            return self.send_json_response(400, {
-                'valid': False,
-                'message': 'JSON 格式错误'
-            })
+            log.error("JSON 解析失败")
+            return raw_json_response(*_ERR_BAD_JSON)
         except Exception as e:
-            print(f"[ERROR] 未知错误: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return self.send_json_response(500, {
-                'valid': False,
-                'message': f'服务器错误: {str(e)}'
-            })
+            # 异常信息只写日志，不返回给调用方（可能包含内部地址）
+            log.exception("未知错误: %s", e)
+            return raw_json_response(*_ERR_SERVER)
+
 
-    def send_json_response(self, status_code, data):
-        """发送 JSON 响应"""
-        self.send_response(status_code)
-        self.send_header('Content-Type', 'application/json')
-        for key, value in cors_headers().items():
-            self.send_header(key, value)
-        self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
\ No newline at end of file
+# Vercel ASGI 入口
+app = Starlette(routes=[Route('/{path:path}', VerifyEndpoint)])
@@ -0,0 +1,80 @@
+-- 许可证验证 + 设备绑定 + 验证日志，在一个事务内完成
+--
+-- 行锁 (FOR UPDATE) 保证并发激活时机器码字段不会互相覆盖。
+-- 返回绑定后的许可证行及状态：ok / disabled / expired / device_limit；
+-- 许可证不存在时返回空结果集。
+create or replace function public.verify_and_bind(
+    p_license_key text,
+    p_machine_id text,
+    p_now bigint,
+    p_ip_address text default null
+)
+returns table (
+    status text,
+    expire_time bigint,
+    is_active boolean,
+    machine_id text,
+    max_devices integer
+)
+language plpgsql
+as $$
+#variable_conflict use_column
+declare
+    lic record;
+    machines text[];
+begin
+    select l.expire_time, l.is_active, l.machine_id, coalesce(l.max_devices, 1) as max_devices
+      into lic
+      from public.licenses l
+     where l.license_key = p_license_key
+       for update;
+
+    if not found then
+        return;
+    end if;
+
+    if not coalesce(lic.is_active, false) then
+        status := 'disabled';
+    elsif p_now > coalesce(lic.expire_time, 0) then
+        -- expire_time 为空视为已过期，不绑定、不记日志
+        status := 'expired';
+    elsif coalesce(lic.machine_id, '') = '' then
+        -- 首次激活
+        lic.machine_id := p_machine_id;
+        update public.licenses
+           set machine_id = p_machine_id, activated_at = p_now
+         where license_key = p_license_key;
+        status := 'ok';
+    else
+        machines := array_remove(
+            array(select btrim(m) from unnest(string_to_array(lic.machine_id, ',')) as m), '');
+        if p_machine_id = any(machines) then
+            status := 'ok';
+        elsif cardinality(machines) >= lic.max_devices then
+            status := 'device_limit';
+        else
+            -- 绑定新设备
+            lic.machine_id := array_to_string(machines || p_machine_id, ',');
+            update public.licenses
+               set machine_id = lic.machine_id
+             where license_key = p_license_key;
+            status := 'ok';
+        end if;
+    end if;
+
+    if status = 'ok' then
+        insert into public.verify_logs (license_key, machine_id, verify_time, ip_address)
+        values (p_license_key, p_machine_id, p_now, p_ip_address);
+    end if;
+
+    expire_time := lic.expire_time;
+    is_active := lic.is_active;
+    machine_id := lic.machine_id;
+    max_devices := lic.max_devices;
+    return next;
+end;
+$$;
+
+-- 仅允许服务端 (service_role) 调用
+revoke execute on function public.verify_and_bind(text, text, bigint, text) from public, anon, authenticated;
+grant execute on function public.verify_and_bind(text, text, bigint, text) to service_role;
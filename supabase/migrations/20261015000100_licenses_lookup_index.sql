@@ -0,0 +1,24 @@
+-- licenses 热路径的索引与存储参数
+--
+-- verify_and_bind 以 SELECT ... FOR UPDATE 按 license_key 读取，加锁读取必须访问堆元组，
+-- 覆盖索引 (INCLUDE expire_time, is_active, machine_id, max_devices) 无法形成 index-only scan，
+-- 还会让绑定设备时的 machine_id 更新失去 HOT。因此只保证 license_key 上有唯一索引。
+do $$
+begin
+    if not exists (
+        select 1
+          from pg_index i
+          join pg_attribute a on a.attrelid = i.indrelid and a.attnum = i.indkey[0]
+         where i.indrelid = 'public.licenses'::regclass
+           and a.attname = 'license_key'
+           and i.indpred is null      -- 部分索引无法服务任意 license_key 的查询
+           and i.indisvalid           -- 失败的并发建索引会留下无效索引
+    ) then
+        create unique index licenses_license_key_idx on public.licenses (license_key);
+    end if;
+end
+$$;
+
+-- 页内预留 10% 空间，machine_id / activated_at 的更新可走 HOT，减少表膨胀
+-- （只影响之后写入的页，已有页在下次 VACUUM FULL 或重写后生效）
+alter table public.licenses set (fillfactor = 90);